@@ -2,16 +2,22 @@ from telegram import Update, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 import os
+import re
 import logging
-from downloader import fetch_video, fetch_photos
+from downloader import fetch_post, create_client, MAX_UPLOAD_SIZE
 import asyncio
 
 # Load token from .env
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Only genuine TikTok links reach the downloader
+TIKTOK_URL_RE = re.compile(r'https?://(?:www\.|vm\.|vt\.|m\.)?tiktok\.com/\S+', re.I)
+# Sentence punctuation and closing brackets that \S+ picks up after a pasted link
+URL_TRAILING_PUNCTUATION = '.,;:!?)]}>"\''
+
+# Configure logging (WARNING in production; set LOG_LEVEL=INFO or DEBUG to troubleshoot)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 logger = logging.getLogger(__name__)
 
 # Bot commands
@@ -65,6 +71,13 @@ async def update_status_message(status_message, text):
     except Exception:
         pass
 
+async def delete_status_later(status_message, delay: float = 5):
+    await asyncio.sleep(delay)
+    try:
+        await status_message.delete()
+    except Exception:
+        pass
+
 # Message handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message is None:
@@ -77,66 +90,76 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text = text.strip()
     chat_id = update.message.chat.id
-    logger.info(f"Received from {chat_id}: {text}")
+    logger.debug("Received from %s: %s", chat_id, text)
 
     # Check if it's a TikTok URL
-    if "tiktok.com" not in text:
-        await update.message.reply_text("❌ Please send a valid TikTok link.\n\nI can only process TikTok videos and photos. Make sure the link contains 'tiktok.com'")
+    match = TIKTOK_URL_RE.search(text)
+    if not match:
+        await update.message.reply_text("❌ Please send a valid TikTok link.\n\nI can only process TikTok videos and photos. Make sure you send the full link, starting with https:// (e.g. https://vt.tiktok.com/...)")
         return
+    text = match.group(0).rstrip(URL_TRAILING_PUNCTUATION)
+
+    client = context.application.bot_data['http_client']
 
     # Send initial response
     status_message = await update.message.reply_text("🔄 Processing your TikTok link...\n\nThis may take a few seconds.")
 
     try:
-        # Try photo post first
-        await update_status_message(status_message, "🔄 Checking if this is a TikTok photo post...")
-        photo_buffers, photo_caption = await fetch_photos(text)
+        # One lookup decides photo post vs video; the video download races it rather than waiting for it
+        status_update = asyncio.create_task(update_status_message(status_message, "🔄 Processing your TikTok link...\n\n⏳ Resolving URL and extracting media..."))
+        photo_buffers, video_bytes, caption = await fetch_post(client, text)
+        await status_update
         if photo_buffers:
-            await update_status_message(status_message, "📸 Downloading TikTok photo post...\n\n📤 Uploading to Telegram...")
+            status_update = asyncio.create_task(update_status_message(status_message, "📸 Downloading TikTok photo post...\n\n📤 Uploading to Telegram..."))
             for idx, img_buffer in enumerate(photo_buffers):
                 await update.message.reply_photo(
                     photo=InputFile(img_buffer, filename=f"tiktok_photo_{idx+1}.jpg"),
-                    caption=photo_caption if idx == 0 else None
+                    caption=caption if idx == 0 else None
                 )
+            await status_update
             await update_status_message(status_message, "✅ TikTok photo post downloaded successfully!\n\n🎉 Enjoy your TikTok photos!")
-            await asyncio.sleep(5)
-            await status_message.delete()
+            # Clean up in the background instead of holding the handler for 5 seconds
+            context.application.create_task(delete_status_later(status_message))
             return
 
-        # Not a photo post, try video as before
-        await update_status_message(status_message, "🔄 Processing your TikTok video...\n\n⏳ Resolving URL and extracting video...")
-        video_bytes, caption = await fetch_video(text)
         if video_bytes:
+            # getvalue() on an untouched BytesIO returns the shared bytes without copying (getbuffer() would copy)
             file_size = len(video_bytes.getvalue())
-            max_size = 50 * 1024 * 1024  # 50MB
-            if file_size > max_size:
+            if file_size > MAX_UPLOAD_SIZE:
                 await update_status_message(status_message, f"❌ Video too large ({file_size // (1024*1024)}MB)\n\nTelegram bot limit is 50MB. Try a shorter video.")
                 return
-            await update_status_message(status_message, "🔄 Processing your TikTok video...\n\n📤 Uploading to Telegram...")
+            status_update = asyncio.create_task(update_status_message(status_message, "🔄 Processing your TikTok video...\n\n📤 Uploading to Telegram..."))
             await update.message.reply_video(
                 video=InputFile(video_bytes, filename="tiktok_video.mp4"), 
                 caption=caption,
                 supports_streaming=True
             )
+            await status_update
             await update_status_message(status_message, "✅ Video downloaded successfully!\n\n🎉 Enjoy your watermark-free TikTok video!")
-            await asyncio.sleep(5)
-            await status_message.delete()
+            context.application.create_task(delete_status_later(status_message))
         else:
             await update_status_message(status_message, "❌ This link is not a valid TikTok video or photo post, or it could not be downloaded.\n\nPossible reasons:\n• Video/photo is private or deleted\n• Region restrictions\n• Network issues\n• Not a supported TikTok post type\n\nTry again or use a different link.")
     except Exception as e:
-        logger.error(f"Download failed: {e}")
+        logger.error("Download failed: %s", e)
         await update_status_message(status_message, "❌ Something went wrong while downloading the video or photo.\n\nError: " + str(e)[:100] + "\n\nPlease try again or contact support.")
 
 # Error handler
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
+
+# Release the shared HTTP connection pool on shutdown
+async def post_shutdown(application: Application):
+    await application.bot_data['http_client'].aclose()
 
 # Main bot runner
 def main():
     if not TOKEN:
         raise RuntimeError("TOKEN is missing from .env")
 
-    app = Application.builder().token(TOKEN).build()
+    # Handle updates concurrently so one user's download/encode doesn't stall the others
+    app = Application.builder().token(TOKEN).concurrent_updates(True).post_shutdown(post_shutdown).build()
+    # One HTTP client for the whole process, shared by every update
+    app.bot_data['http_client'] = create_client()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -1,124 +1,433 @@
 from io import BytesIO
 import httpx
 import re
-import json
+import orjson
 import urllib.parse
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict
 import tempfile
 import subprocess
+import asyncio
+import socket
+import time
+import httpcore
+import os
+import shutil
+import logging
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
 
-async def resolve_redirect(url: str) -> str:
-    """Resolve TikTok redirects to get the final URL"""
-    async with httpx.AsyncClient(follow_redirects=True, timeout=10) as client:
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+}
+
+# Matches /video/<id>, video/<id> and /v/<id>
+_VIDEO_ID_RE = re.compile(r'(?:/v|video)/(\d+)')
+
+# How long resolved addresses for tikwm.com / tiktokv.com / CDN hosts are reused, and how many
+# hosts are remembered (TikTok spreads media over many per-region CDN hostnames)
+DNS_CACHE_TTL = 300
+DNS_CACHE_SIZE = 1024
+
+class _CachingDNSBackend(httpcore.AsyncNetworkBackend):
+    """Network backend that caches resolved host addresses for DNS_CACHE_TTL seconds"""
+
+    def __init__(self, ttl: float = DNS_CACHE_TTL, maxsize: int = DNS_CACHE_SIZE):
+        self._backend = httpcore.AnyIOBackend()
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def _resolve(self, host: str, port: int) -> List[str]:
+        cached = self._cache.get((host, port))
+        if cached is not None:
+            return cached
         try:
-            r = await client.get(url)
-            return str(r.url)
-        except Exception:
-            return url
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        # Keep every A/AAAA record (in resolver order, without duplicates) so one dead address isn't fatal
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        if not addresses:
+            raise httpcore.ConnectError(f"No addresses found for {host}")
+        self._cache[(host, port)] = addresses
+        return addresses
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addresses = await self._resolve(host, port)
+        # Iterate over a copy: a concurrent connect may reorder the cached list
+        for index, address in enumerate(list(addresses)):
+            try:
+                # TLS still uses the original hostname for SNI/verification
+                stream = await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+                continue
+            if index and self._cache.get((host, port)) is addresses:
+                # Try the working address first from now on (reorders in place, keeping the entry's expiry)
+                addresses[:] = addresses[index:] + addresses[:index]
+            return stream
+        # The cached addresses may be stale (refused or blackholed), resolve again next time
+        self._cache.pop((host, port), None)
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+class _CachingDNSTransport(httpx.AsyncHTTPTransport):
+    """AsyncHTTPTransport whose connection pool resolves hosts through _CachingDNSBackend"""
+
+    def __init__(self, limits: httpx.Limits, retries: int = 1, http2: bool = True):
+        # httpx (pinned to 0.25) has no network_backend option and its transport holds nothing
+        # but the pool, so build that pool once here instead of calling super().__init__
+        # and throwing away the pool and SSL context it creates
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(http2=http2),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http2=http2,
+            retries=retries,
+            network_backend=_CachingDNSBackend(),
+        )
+
+# Pool sizing for the shared client: room for many concurrent users, with idle
+# connections kept warm for a minute between requests. HTTP/2 is negotiated where
+# the server supports it, so concurrent image downloads multiplex over one connection
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+
+def create_client() -> httpx.AsyncClient:
+    """Create the AsyncClient shared by all downloader calls; the caller owns and closes it"""
+    return httpx.AsyncClient(
+        transport=_CachingDNSTransport(HTTP_LIMITS),
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        follow_redirects=True,
+        headers=DEFAULT_HEADERS,
+    )
 
-async def extract_video_id(url: str) -> Optional[str]:
+# Successful TikWM responses (metadata and media URLs only) and redirect targets,
+# so popular links shared by many users skip the network round-trips
+_TIKWM_CACHE: TTLCache = TTLCache(maxsize=512, ttl=3600)
+_REDIRECT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=86400)
+
+async def resolve_redirect(client: httpx.AsyncClient, url: str) -> str:
+    """Resolve TikTok redirects to get the final URL"""
+    key = canonicalize_tiktok_url(url)
+    cached = _REDIRECT_CACHE.get(key)
+    if cached is not None:
+        return cached
+    try:
+        r = await client.get(url, timeout=10)
+    except Exception:
+        return url
+    resolved_url = str(r.url)
+    _REDIRECT_CACHE[key] = resolved_url
+    return resolved_url
+
+def extract_video_id(url: str) -> Optional[str]:
     """Extract video ID from TikTok URL"""
-    patterns = [
-        r'/video/(\d+)',
-        r'/v/(\d+)',
-        r'video/(\d+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+def strip_tracking(url: str) -> str:
+    """Drop the query string and fragment (share tracking like _t, _r) and lowercase the host"""
+    parts = urllib.parse.urlsplit(url.strip())
+    return urllib.parse.urlunsplit(('https', parts.netloc.lower(), parts.path, '', ''))
+
+def video_id_key(video_id) -> str:
+    """Cache key shared by every link to the same video"""
+    return f"https://www.tiktok.com/video/{video_id}"
+
+def canonicalize_tiktok_url(url: str) -> str:
+    """Return one key for all forms of a TikTok link: the video URL if the ID is known, else the stripped link"""
+    video_id = extract_video_id(url)
+    if video_id:
+        return video_id_key(video_id)
+    return strip_tracking(url).rstrip('/')
+
+# Size of the slices written to a subprocess's stdin, so the pipe transport never buffers a whole video
+PIPE_CHUNK_SIZE = 65536
+
+async def _feed_stdin(stream: asyncio.StreamWriter, data: bytes) -> None:
+    try:
+        with memoryview(data) as view:
+            for pos in range(0, len(view), PIPE_CHUNK_SIZE):
+                stream.write(view[pos:pos + PIPE_CHUNK_SIZE])
+                await stream.drain()
+        stream.close()
+    except (BrokenPipeError, ConnectionResetError):
+        # The process exited without reading all of its input (e.g. ffprobe)
+        pass
+
+# Upper bound on ffmpeg/ffprobe child processes alive at once (probes included)
+MAX_PROCESSES = os.cpu_count() or 1
+_PROCESS_SEM = asyncio.Semaphore(MAX_PROCESSES)
+
+async def run_process(cmd: List[str], input_bytes: Optional[bytes] = None) -> bytes:
+    """Run cmd without blocking the event loop; return stdout or raise CalledProcessError."""
+    async with _PROCESS_SEM:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE if input_bytes is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        try:
+            feed = _feed_stdin(proc.stdin, input_bytes) if input_bytes is not None else asyncio.sleep(0)
+            _, stdout, stderr, _ = await asyncio.gather(feed, proc.stdout.read(), proc.stderr.read(), proc.wait())
+        except asyncio.CancelledError:
+            # Don't leave an orphaned ffmpeg running when the caller gives up
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+    return stdout
+
+# tmpfs scratch space for ffmpeg temp files, so short-lived videos never touch the disk
+SHM_DIR = '/dev/shm'
+
+def scratch_dir(size_hint: int) -> Optional[str]:
+    """Return SHM_DIR if it is writable with room to spare for size_hint bytes, else None (default temp dir)."""
+    try:
+        if os.access(SHM_DIR, os.W_OK) and shutil.disk_usage(SHM_DIR).free > 2 * size_hint:
+            return SHM_DIR
+    except OSError:
+        pass
     return None
 
-def get_video_dimensions(input_bytes: bytes) -> tuple:
-    """Return (width, height) of video using ffprobe."""
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True) as in_file:
-        in_file.write(input_bytes)
-        in_file.flush()
-        cmd = [
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
-            '-of', 'json', in_file.name
-        ]
+def _write_and_flush(file, data: bytes) -> None:
+    file.write(data)
+    file.flush()
+
+@asynccontextmanager
+async def ffmpeg_input(input_bytes: bytes, pipeable: bool):
+    """
+    Yield (input argument, stdin data) for ffmpeg/ffprobe.
+    Pipeable (faststart) input is fed through stdin; otherwise the demuxer
+    needs to seek to the trailing moov atom, so the bytes go to a temp file.
+    """
+    if pipeable:
+        yield 'pipe:0', input_bytes
+        return
+    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True, dir=scratch_dir(len(input_bytes))) as in_file:
+        # Disk writes of a whole video run off the event loop
+        write = asyncio.ensure_future(asyncio.to_thread(_write_and_flush, in_file, input_bytes))
         try:
-            result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            info = json.loads(result.stdout)
-            width = info['streams'][0]['width']
-            height = info['streams'][0]['height']
-            return width, height
-        except Exception as e:
-            print(f"ffprobe failed: {e}")
-            return None, None
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # The thread can't be stopped and still reads input_bytes (often a view of a pooled
+            # buffer); let it finish, even through repeated cancels, before the caller releases it
+            while not write.done():
+                try:
+                    await asyncio.wait({write})
+                except asyncio.CancelledError:
+                    pass
+            raise
+        yield in_file.name, None
 
-def check_h264_codec(file_path: str) -> bool:
-    """Return True if the video stream in file_path is H.264, else False."""
+async def probe_streams(source: str, input_bytes: Optional[bytes] = None) -> List[dict]:
+    """Return the stream descriptions of source ('pipe:0' reads input_bytes) using ffprobe."""
     cmd = [
-        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-        '-show_entries', 'stream=codec_name',
-        '-of', 'default=noprint_wrappers=1:nokey=1', file_path
+        'ffprobe', '-v', 'quiet', '-print_format', 'json',
+        '-show_streams', source
     ]
     try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        codec = result.stdout.decode().strip()
-        return codec == 'h264'
+        stdout = await run_process(cmd, input_bytes)
+        return orjson.loads(stdout).get('streams', [])
     except Exception as e:
-        print(f"ffprobe codec check failed: {e}")
+        logger.warning("ffprobe failed: %s", e)
+        return []
+
+def moov_before_mdat(data: bytes) -> bool:
+    """Return True if the MP4 'moov' atom precedes 'mdat' (i.e. faststart is already applied)."""
+    view = memoryview(data)
+    pos = 0
+    while pos + 8 <= len(view):
+        size = int.from_bytes(view[pos:pos + 4], 'big')
+        box_type = bytes(view[pos + 4:pos + 8])
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1:
+            # 64-bit size follows the box type
+            if pos + 16 > len(view):
+                break
+            size = int.from_bytes(view[pos + 8:pos + 16], 'big')
+        if size < 8:
+            # size 0 means the box runs to the end of the file
+            break
+        pos += size
+    return False
+
+# How far the short/long side ratio may drift from 9:16 and still count as 9:16 / 16:9
+ASPECT_TOLERANCE = 0.02
+# Telegram's upload limit for bots; larger sources are re-encoded (720p, 2M maxrate) to fit under it
+MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+def matches_target_profile(streams: List[dict]) -> bool:
+    """Return True if the streams are already H.264/yuv420p at 9:16 or 16:9 with AAC (or no) audio."""
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None or video.get('codec_name') != 'h264' or video.get('pix_fmt') != 'yuv420p':
+        return False
+    width, height = video.get('width'), video.get('height')
+    if not width or not height:
         return False
+    if abs(min(width, height) / max(width, height) - 9 / 16) > ASPECT_TOLERANCE:
+        return False
+    return audio is None or audio.get('codec_name') == 'aac'
+
+# Center-crop and scale in a single filter chain; ffmpeg picks the orientation from the
+# frame size itself (height >= width is portrait), so no separate dimension probe is needed:
+# - portrait: crop to 9:16, scale to 720x1280
+# - landscape: crop to 16:9, scale to 1280x720
+STANDARD_VF = (
+    "crop="
+    "'if(gte(ih,iw),ih*9/16,iw)':'if(gte(ih,iw),ih,iw*9/16)':"
+    "'if(gte(ih,iw),(iw-ih*9/16)/2,0)':'if(gte(ih,iw),0,(ih-iw*9/16)/2)',"
+    "scale='if(gte(ih,iw),720,1280)':'if(gte(ih,iw),1280,720)',"
+    "setsar=1"
+)
+
+# Encodes allowed to run at once (half the cores); each gets an equal share of the CPU cores
+MAX_CONCURRENT_ENCODES = max(1, (os.cpu_count() or 1) // 2)
+ENCODE_THREADS = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_ENCODES)
+_ENCODE_SEM = asyncio.Semaphore(MAX_CONCURRENT_ENCODES)
 
-def convert_to_standard_mp4(input_bytes: bytes) -> bytes:
+# H.264 encoder arguments, in order of preference; hardware encoders are used when this
+# ffmpeg build lists them, and libx264 is always the fallback
+H264_ENCODER_ARGS = {
+    'h264_nvenc': ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'hq', '-rc', 'vbr', '-cq', '23', '-profile:v', 'baseline'],
+    'h264_qsv': ['-c:v', 'h264_qsv', '-preset', 'veryfast', '-global_quality', '23', '-profile:v', 'baseline'],
+    'h264_videotoolbox': ['-c:v', 'h264_videotoolbox', '-b:v', '2M', '-profile:v', 'baseline'],
+    'libx264': ['-c:v', 'libx264', '-profile:v', 'baseline', '-level', '3.1', '-crf', '23', '-preset', 'veryfast',
+                '-threads', str(ENCODE_THREADS)],
+}
+_H264_ENCODER: Optional[str] = None
+
+async def pick_h264_encoder() -> str:
+    """Return the preferred H.264 encoder this ffmpeg supports (probed once)."""
+    global _H264_ENCODER
+    if _H264_ENCODER is None:
+        try:
+            listing = (await run_process(['ffmpeg', '-hide_banner', '-encoders'])).decode()
+        except Exception as e:
+            logger.warning("ffmpeg encoder probe failed: %s", e)
+            listing = ''
+        available = {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+        _H264_ENCODER = next((name for name in H264_ENCODER_ARGS if name in available), 'libx264')
+        logger.info("Using H.264 encoder: %s", _H264_ENCODER)
+    return _H264_ENCODER
+
+def build_encode_cmd(source: str, out_path: str, encoder: str) -> List[str]:
+    """Build the full re-encode command for the given H.264 encoder."""
+    return [
+        'ffmpeg',
+        '-analyzeduration', '2147483647',
+        '-probesize', '2147483647',
+        '-y', '-i', source,
+        '-vf', STANDARD_VF,
+        *H264_ENCODER_ARGS[encoder], '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '128k', '-ar', '44100',
+        '-movflags', '+faststart',
+        '-map_metadata', '-1',
+        '-metadata:s:v', 'rotate=0',
+        '-maxrate', '2M', '-bufsize', '4M',
+        out_path
+    ]
+
+async def encode_standard_mp4(source: str, stdin_bytes: Optional[bytes], out_path: str) -> None:
+    """Re-encode source into out_path, falling back to libx264 if the hardware encoder fails."""
+    global _H264_ENCODER
+    encoder = await pick_h264_encoder()
+    try:
+        await run_process(build_encode_cmd(source, out_path, encoder), stdin_bytes)
+    except subprocess.CalledProcessError as e:
+        if encoder == 'libx264':
+            raise
+        logger.warning("%s encode failed, falling back to libx264: %s", encoder, e)
+        await run_process(build_encode_cmd(source, out_path, 'libx264'), stdin_bytes)
+        # libx264 managed what the listed encoder couldn't (e.g. no GPU/device on this host):
+        # stick to libx264 from now on. A broken input fails both and changes nothing
+        _H264_ENCODER = 'libx264'
+
+async def convert_to_standard_mp4(input_bytes: bytes) -> bytes:
     """
     Convert video bytes to standard MP4 (H.264/AAC) using ffmpeg.
+    - If the input is already H.264/yuv420p/AAC at 9:16 or 16:9 and within MAX_UPLOAD_SIZE,
+      skip re-encoding (returned as-is when faststart, otherwise stream-copied with +faststart)
     - For portrait: crop to 9:16 (centered), scale to 720x1280, setsar=1
     - For landscape: crop to 16:9 (centered), scale to 1280x720, setsar=1
+    - Encodes on a hardware H.264 encoder when available, else libx264
     This matches Stack Overflow best practices for Telegram/iOS display.
     """
-    width, height = get_video_dimensions(input_bytes)
-    if width is None or height is None:
-        # fallback: treat as portrait
-        portrait = True
-    else:
-        portrait = height >= width
-    with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True) as in_file, \
-         tempfile.NamedTemporaryFile(suffix='.mp4', delete=True) as out_file:
-        in_file.write(input_bytes)
-        in_file.flush()
-        if portrait:
-            # Portrait: crop to 9:16, scale to 720x1280, setsar=1
-            vf = "crop=ih*9/16:ih:(iw-ih*9/16)/2:0,scale=720:1280,setsar=1"
-        else:
-            # Landscape: crop to 16:9, scale to 1280x720, setsar=1
-            vf = "crop=iw:iw*9/16:0:(ih-iw*9/16)/2,scale=1280:720,setsar=1"
-        cmd = [
-            'ffmpeg',
-            '-analyzeduration', '2147483647',
-            '-probesize', '2147483647',
-            '-y', '-i', in_file.name,
-            '-vf', vf,
-            '-c:v', 'libx264', '-profile:v', 'baseline', '-level', '3.1', '-crf', '23', '-preset', 'fast', '-pix_fmt', 'yuv420p',
-            '-c:a', 'aac', '-b:a', '128k', '-ar', '44100',
-            '-movflags', '+faststart',
-            '-map_metadata', '-1',
-            '-metadata:s:v', 'rotate=0',
-            '-threads', '1',
-            '-maxrate', '2M', '-bufsize', '4M',
-            out_file.name
-        ]
-        try:
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            # Post-process: check codec
-            if not check_h264_codec(out_file.name):
-                print("WARNING: Output video is not H.264! Telegram/iOS compatibility may be affected.")
-            out_file.seek(0)
-            return out_file.read()
-        except Exception as e:
-            print(f"ffmpeg conversion failed: {e}")
-            return input_bytes
-async def tikwm_api_request(tiktok_url: str) -> Optional[dict]:
-    """Helper to call TikWM API and return parsed JSON or None."""
+    faststart = moov_before_mdat(input_bytes)
+    async with ffmpeg_input(input_bytes, pipeable=faststart) as (source, stdin_bytes):
+        # Output stays a temp file: +faststart rewrites it in place, which needs a seekable target
+        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=True, dir=scratch_dir(len(input_bytes))) as out_file:
+            streams = await probe_streams(source, stdin_bytes)
+            # Passing through only pays off if the result can still be uploaded
+            remux = matches_target_profile(streams) and len(input_bytes) <= MAX_UPLOAD_SIZE
+            if remux and faststart:
+                # Already a streamable H.264/AAC MP4 in a Telegram-friendly shape
+                return bytes(input_bytes)
+            try:
+                if remux:
+                    # Only the layout needs fixing: remux with faststart, no re-encode. A stream
+                    # copy is cheap, so it is bounded by run_process alone, not the encode gate
+                    await run_process([
+                        'ffmpeg', '-y', '-i', source,
+                        '-c', 'copy',
+                        '-movflags', '+faststart',
+                        '-map_metadata', '-1',
+                        out_file.name
+                    ], stdin_bytes)
+                else:
+                    async with _ENCODE_SEM:
+                        await encode_standard_mp4(source, stdin_bytes, out_file.name)
+                out_file.seek(0)
+                return await asyncio.to_thread(out_file.read)
+            except Exception as e:
+                logger.warning("ffmpeg conversion failed: %s", e)
+                return bytes(input_bytes)
+# At most TIKWM_CONCURRENCY requests in flight, started at least TIKWM_MIN_INTERVAL apart;
+# throttled requests are retried with exponential backoff
+TIKWM_CONCURRENCY = 4
+TIKWM_MIN_INTERVAL = 0.5
+TIKWM_MAX_RETRIES = 3
+_TIKWM_SEM = asyncio.Semaphore(TIKWM_CONCURRENCY)
+_TIKWM_INTERVAL_LOCK = asyncio.Lock()
+_TIKWM_LAST = 0.0
+
+async def _wait_min_interval(interval: float) -> None:
+    """Wait until at least interval seconds have passed since the previous TikWM request"""
+    global _TIKWM_LAST
+    async with _TIKWM_INTERVAL_LOCK:
+        delay = _TIKWM_LAST + interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        _TIKWM_LAST = time.monotonic()
+
+def _is_rate_limited(data: dict) -> bool:
+    """TikWM reports throttling as a non-zero code with a 'limit' message"""
+    return 'limit' in str(data.get('msg', '')).lower()
+
+async def tikwm_api_request(client: httpx.AsyncClient, tiktok_url: str,
+                            sent: Optional[asyncio.Event] = None) -> Optional[dict]:
+    """Helper to call TikWM API and return parsed JSON or None; sent is set once the POST goes out."""
+    key = canonicalize_tiktok_url(tiktok_url)
+    cached = _TIKWM_CACHE.get(key)
+    if cached is not None:
+        return cached
     service_url = "https://tikwm.com/api/"
-    data = {
-        'url': tiktok_url,
+    form = {
+        'url': strip_tracking(tiktok_url),
         'hd': '1'
     }
     service_headers = {
@@ -128,100 +437,362 @@ async def tikwm_api_request(tiktok_url: str) -> Optional[dict]:
         'Origin': 'https://tikwm.com',
         'Referer': 'https://tikwm.com/',
     }
-    async with httpx.AsyncClient(timeout=30) as client:
-        response = await client.post(service_url, data=data, headers=service_headers)
-        print(f"TikWM API response: {response.status_code}")
-        if response.status_code == 200:
+    async with _TIKWM_SEM:
+        for attempt in range(TIKWM_MAX_RETRIES + 1):
+            await _wait_min_interval(TIKWM_MIN_INTERVAL)
+            if sent is not None:
+                sent.set()
             try:
-                data = response.json()
+                response = await client.post(service_url, data=form, headers=service_headers)
+            except httpx.HTTPError as e:
+                logger.warning("TikWM API request failed: %s", e)
+                return None
+            logger.debug("TikWM API response: %s", response.status_code)
+            if response.status_code == 200:
+                try:
+                    data = orjson.loads(response.content)
+                except orjson.JSONDecodeError:
+                    logger.warning("Failed to parse TikWM JSON response")
+                    return None
                 if data.get('code') == 0:
+                    _TIKWM_CACHE[key] = data
+                    # Also file it under the video ID so full links hit after a short link (and vice versa)
+                    video_id = (data.get('data') or {}).get('id')
+                    if video_id:
+                        _TIKWM_CACHE[video_id_key(video_id)] = data
                     return data
-            except json.JSONDecodeError:
-                print("Failed to parse TikWM JSON response")
+                if not _is_rate_limited(data):
+                    return None
+            elif response.status_code != 429:
+                return None
+            if attempt < TIKWM_MAX_RETRIES:
+                backoff = min(2 ** attempt, 10)
+                logger.debug("TikWM rate limited, retrying in %ss", backoff)
+                await asyncio.sleep(backoff)
     return None
 
-async def fetch_video(tiktok_url: str) -> Tuple[Optional[BytesIO], Optional[str]]:
-    """Fetch TikTok video without watermark - optimized version"""
+def is_photo_post(tikwm_data: Optional[dict]) -> bool:
+    """Whether a TikWM payload describes a photo post rather than a video"""
+    images = ((tikwm_data or {}).get('data') or {}).get('images')
+    return bool(images) and isinstance(images, list)
+
+class TikwmLookup:
+    """A TikWM lookup running in the background, shared by the photo, video and fallback paths"""
+
+    def __init__(self, client: httpx.AsyncClient, tiktok_url: str):
+        self.sent = asyncio.Event()
+        self.task = asyncio.ensure_future(tikwm_api_request(client, tiktok_url, self.sent))
+        # Cache hits and early failures never send a POST; nobody should wait on them either
+        self.task.add_done_callback(lambda _: self.sent.set())
+
+    async def result(self) -> Optional[dict]:
+        """The TikWM payload, or None if the lookup failed; cancelling the caller leaves the lookup running"""
+        return await asyncio.shield(self.task)
+
+    def found_photo_post(self) -> bool:
+        """Whether the lookup has finished and found a photo post"""
+        task = self.task
+        return task.done() and not task.cancelled() and task.exception() is None and is_photo_post(task.result())
+
+# Running TikWM lookups by canonical URL, so concurrent requests for the same link share one POST
+_TIKWM_LOOKUPS: Dict[str, TikwmLookup] = {}
+
+def shared_tikwm_lookup(client: httpx.AsyncClient, tiktok_url: str) -> TikwmLookup:
+    """Return the running TikWM lookup for this link, starting one if there is none"""
+    key = canonicalize_tiktok_url(tiktok_url)
+    lookup = _TIKWM_LOOKUPS.get(key)
+    if lookup is None:
+        lookup = TikwmLookup(client, tiktok_url)
+        _TIKWM_LOOKUPS[key] = lookup
+        lookup.task.add_done_callback(lambda _: _TIKWM_LOOKUPS.pop(key, None))
+    return lookup
+
+# Number of reusable download buffers; also caps concurrent video downloads
+MAX_CONCURRENT_DOWNLOADS = 4
+# Buffers that grew beyond this are dropped instead of being kept in the pool
+MAX_POOLED_BUFFER_SIZE = 64 * 1024 * 1024
+
+class BufferPool:
+    """Pool of reusable bytearrays used to stage video downloads"""
+
+    def __init__(self, size: int, max_buffer_size: int = MAX_POOLED_BUFFER_SIZE):
+        self._max_buffer_size = max_buffer_size
+        self._queue: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            self._queue.put_nowait(bytearray())
+
+    async def acquire(self) -> bytearray:
+        """Wait for a free buffer; its previous contents are overwritten in place"""
+        return await self._queue.get()
+
+    def release(self, buf: bytearray) -> None:
+        """Return a buffer to the pool"""
+        if len(buf) > self._max_buffer_size:
+            buf = bytearray()
+        self._queue.put_nowait(buf)
+
+BUFFER_POOL = BufferPool(MAX_CONCURRENT_DOWNLOADS)
+
+async def download_into(client: httpx.AsyncClient, buf: bytearray, url: str, headers: Optional[dict] = None,
+                        timeout: float = 30) -> Optional[int]:
+    """Stream a response body into buf, returning the body length or None on a non-200 status"""
+    async with client.stream("GET", url, headers=headers, timeout=timeout) as response:
+        logger.debug("Download response: %s", response.status_code)
+        if response.status_code != 200:
+            return None
+        size = int(response.headers.get("content-length", 0))
+        if size > len(buf):
+            # Grow once up front instead of repeatedly while streaming
+            buf.extend(bytes(size - len(buf)))
+        length = 0
+        async for chunk in response.aiter_bytes(chunk_size=65536):
+            # Slice assignment overwrites in place and only grows past the end
+            buf[length:length + len(chunk)] = chunk
+            length += len(chunk)
+        return length
+
+async def download_and_convert(client: httpx.AsyncClient, url: str, headers: Optional[dict] = None,
+                               timeout: float = 30, min_size: int = 0) -> Optional[bytes]:
+    """Download a video into a pooled buffer and convert it to standard MP4"""
+    buf = await BUFFER_POOL.acquire()
     try:
-        # Resolve redirects
-        resolved_url = await resolve_redirect(tiktok_url)
-        print(f"Resolved URL: {resolved_url}")
-        
-        # Extract video ID
-        video_id = await extract_video_id(resolved_url)
-        if not video_id:
-            print("❌ Could not extract video ID")
+        length = await download_into(client, buf, url, headers=headers, timeout=timeout)
+        if length is None or length <= min_size:
+            return None
+        with memoryview(buf) as view, view[:length] as video_bytes:
+            return await convert_to_standard_mp4(video_bytes)
+    finally:
+        BUFFER_POOL.release(buf)
+
+# In-flight video fetches by canonical URL, so concurrent requests for the same link share one pipeline
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+# Converted videos by video ID key (canonical URL if the ID never became known), bounded by their
+# total size rather than entry count. Short vt./vm. links differ per share, so _VIDEO_KEYS maps
+# each link already seen to the video ID key its video is filed under
+VIDEO_CACHE_BYTES = 256 * 1024 * 1024
+_VIDEO_CACHE: TTLCache = TTLCache(maxsize=VIDEO_CACHE_BYTES, ttl=3600, getsizeof=lambda entry: len(entry[0]))
+_VIDEO_KEYS: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+
+def _cached_video(key: str) -> Optional[Tuple[bytes, str]]:
+    """Return the cached (bytes, caption) for a canonical link, following it to its video ID key"""
+    return _VIDEO_CACHE.get(_VIDEO_KEYS.get(key, key))
+
+async def _join_by_id(video_id, key: str) -> Optional[Tuple[bytes, str, str]]:
+    """
+    Once a fetch for the link key learns its video ID, reuse a cached or in-flight fetch of the
+    same video started from another link; otherwise file this fetch under the ID so others join it.
+    """
+    id_key = video_id_key(video_id)
+    if id_key == key:
+        return None
+    cached = _VIDEO_CACHE.get(id_key)
+    if cached is not None:
+        return cached[0], cached[1], str(video_id)
+    own = _INFLIGHT.get(key)
+    other = _INFLIGHT.get(id_key)
+    if other is None:
+        if own is not None:
+            _INFLIGHT[id_key] = own
+
+            def forget(_):
+                if _INFLIGHT.get(id_key) is own:
+                    del _INFLIGHT[id_key]
+            own.add_done_callback(forget)
+        return None
+    if other is own:
+        return None
+    result = await asyncio.shield(other)
+    return result if result[0] is not None else None
+
+async def fetch_video(client: httpx.AsyncClient, tiktok_url: str,
+                      tikwm_lookup: Optional[TikwmLookup] = None) -> Tuple[Optional[BytesIO], Optional[str]]:
+    """
+    Fetch TikTok video without watermark, reusing a cached or in-progress fetch of the same link.
+    tikwm_lookup is a TikWM lookup the caller already started; its result, including a failed
+    (None) one, is used instead of asking TikWM again.
+    """
+    key = canonicalize_tiktok_url(tiktok_url)
+    cached = _cached_video(key)
+    if cached is not None:
+        video_bytes, caption = cached
+    else:
+        future = _INFLIGHT.get(key)
+        if future is None:
+            future = asyncio.ensure_future(_fetch_video(client, tiktok_url, key, tikwm_lookup))
+            _INFLIGHT[key] = future
+            future.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+        # Shield so one caller going away doesn't cancel the fetch for the others
+        video_bytes, caption, video_id = await asyncio.shield(future)
+        if video_bytes is None:
             return None, None
+        if len(video_bytes) <= VIDEO_CACHE_BYTES:
+            cache_key = video_id_key(video_id) if video_id else key
+            _VIDEO_CACHE[cache_key] = (video_bytes, caption)
+            if cache_key != key:
+                _VIDEO_KEYS[key] = cache_key
+    # Each caller gets its own BytesIO (and read position) over the shared bytes
+    return BytesIO(video_bytes), caption
+
+# How long TikWM gets to answer, counted from when its POST is sent, before the direct TikTok API
+# is tried in parallel
+FALLBACK_HEAD_START = 2.0
+
+async def _try_tikwm(client: httpx.AsyncClient, key: str, tikwm_lookup: TikwmLookup,
+                     responded: asyncio.Event) -> Optional[Tuple[bytes, str, Optional[str]]]:
+    """Primary method: TikWM API (POST) - most reliable"""
+    try:
+        tikwm_data = await tikwm_lookup.result()
+        # Photo posts carry their soundtrack as 'play'; they are not videos
+        if tikwm_data and not is_photo_post(tikwm_data):
+            info = tikwm_data.get('data') or {}
+            hd_url = info.get('hdplay')
+            video_url = hd_url or info.get('play')
+            video_id = str(info['id']) if info.get('id') else None
+            if video_url:
+                responded.set()
+                if video_id:
+                    joined = await _join_by_id(video_id, key)
+                    if joined is not None:
+                        return joined
+                # Download and convert to standard MP4
+                converted_bytes = await download_and_convert(client, video_url, timeout=60)
+                if converted_bytes is not None:
+                    quality = "HD" if hd_url else "Standard"
+                    return converted_bytes, f"Downloaded via TikWM ({quality}) - {info.get('title', 'TikTok Video')}", video_id
+    except Exception as e:
+        logger.warning("TikWM API failed: %s", e)
+    return None
+
+async def _try_tiktok_api(client: httpx.AsyncClient, key: str, resolve_task: asyncio.Task, tikwm_lookup: TikwmLookup,
+                          primary: asyncio.Task, responded: asyncio.Event) -> Optional[Tuple[bytes, str, str]]:
+    """Fallback method: Direct TikTok API, started if TikWM is slow to answer or fails"""
+    # Time spent queued behind the TikWM throttle does not eat into the head start
+    await tikwm_lookup.sent.wait()
+    await asyncio.wait({primary}, timeout=FALLBACK_HEAD_START)
+    if responded.is_set():
+        # TikWM answered in time and is downloading; only step in if that fails
+        await asyncio.wait({primary})
+    if tikwm_lookup.found_photo_post():
+        return None
+
+    resolved_url = await resolve_task
+    logger.debug("Resolved URL: %s", resolved_url)
+
+    # Extract video ID
+    video_id = extract_video_id(resolved_url)
+    if not video_id:
+        logger.warning("Could not extract video ID from %s", resolved_url)
+        return None
+
+    logger.debug("Video ID: %s", video_id)
+    joined = await _join_by_id(video_id, key)
+    if joined is not None:
+        return joined
+
+    try:
+        api_url = f"https://api.tiktokv.com/aweme/v1/play/?video_id={video_id}&vr_type=0&is_play_url=1&source=PackSourceEnum_PUBLISH&media_id={video_id}&ratio=720p&line=0&file_id={video_id}&quality=720p&watermark=0"
+        api_headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Referer': 'https://www.tiktok.com/',
+            'X-Requested-With': 'com.zhiliaoapp.musically',
+            'Accept': 'video/webm,video/ogg,video/*;q=0.9,application/ogg;q=0.7,audio/*;q=0.6,*/*;q=0.5',
+        }
+
+        # Download and convert to standard MP4
+        converted_bytes = await download_and_convert(client, api_url, headers=api_headers, min_size=1000)
+
+        if converted_bytes is not None:
+            return converted_bytes, f"Downloaded via TikTok API (ID: {video_id})", video_id
+    except Exception as e:
+        logger.warning("TikTok API fallback failed: %s", e)
+    return None
+
+async def _fetch_video(client: httpx.AsyncClient, tiktok_url: str, key: str, tikwm_lookup: Optional[TikwmLookup]
+                       ) -> Tuple[Optional[bytes], Optional[str], Optional[str]]:
+    """Fetch TikTok video bytes, caption and video ID without watermark, racing TikWM against the direct API fallback"""
+    if tikwm_lookup is None:
+        tikwm_lookup = shared_tikwm_lookup(client, tiktok_url)
+    # Resolve redirects in the background; only the fallback needs the video ID
+    resolve_task = asyncio.create_task(resolve_redirect(client, tiktok_url))
+    responded = asyncio.Event()
+    primary = asyncio.create_task(_try_tikwm(client, key, tikwm_lookup, responded))
+    fallback = asyncio.create_task(_try_tiktok_api(client, key, resolve_task, tikwm_lookup, primary, responded))
+    pending = {primary, fallback}
+    try:
+        # The first method to produce a video wins; the other is cancelled
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result is not None:
+                    return result
         
-        print(f"Video ID: {video_id}")
-        
-        # Primary method: TikWM API (POST) - most reliable
-        try:
-            tikwm_data = await tikwm_api_request(tiktok_url)
-            if tikwm_data:
-                video_url = tikwm_data.get('data', {}).get('hdplay') or tikwm_data.get('data', {}).get('play')
-                if video_url:
-                    async with httpx.AsyncClient(timeout=60) as client:
-                        video_response = await client.get(video_url)
-                        if video_response.status_code == 200:
-                            # Convert to standard MP4
-                            converted_bytes = convert_to_standard_mp4(video_response.content)
-                            buffer = BytesIO(converted_bytes)
-                            quality = "HD" if tikwm_data.get('data', {}).get('hdplay') else "Standard"
-                            return buffer, f"Downloaded via TikWM ({quality}) - {tikwm_data.get('data', {}).get('title', 'TikTok Video')}"
-        except Exception as e:
-            print(f"TikWM API failed: {e}")
-        
-        # Fallback method: Direct TikTok API (if TikWM fails)
-        try:
-            api_url = f"https://api.tiktokv.com/aweme/v1/play/?video_id={video_id}&vr_type=0&is_play_url=1&source=PackSourceEnum_PUBLISH&media_id={video_id}&ratio=720p&line=0&file_id={video_id}&quality=720p&watermark=0"
-            api_headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Referer': 'https://www.tiktok.com/',
-                'X-Requested-With': 'com.zhiliaoapp.musically',
-                'Accept': 'video/webm,video/ogg,video/*;q=0.9,application/ogg;q=0.7,audio/*;q=0.6,*/*;q=0.5',
-            }
-            
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(api_url, headers=api_headers)
-                print(f"TikTok API fallback response: {response.status_code}")
-                
-                if response.status_code == 200 and len(response.content) > 1000:
-                    # Convert to standard MP4
-                    converted_bytes = convert_to_standard_mp4(response.content)
-                    buffer = BytesIO(converted_bytes)
-                    return buffer, f"Downloaded via TikTok API (ID: {video_id})"
-        except Exception as e:
-            print(f"TikTok API fallback failed: {e}")
-        
-        print("❌ All download methods failed")
-        return None, None
+        if not tikwm_lookup.found_photo_post():
+            logger.warning("All download methods failed for %s", tiktok_url)
+        return None, None, None
         
     except Exception as e:
-        print(f"⚠️ Download error: {e}")
-        return None, None
+        logger.error("Download error: %s", e)
+        return None, None, None
+    finally:
+        for task in (primary, fallback, resolve_task):
+            task.cancel()
+
+# Images of one photo post downloaded at once (multiplexed over HTTP/2 where possible)
+PHOTO_DOWNLOAD_CONCURRENCY = 8
 
-async def fetch_photos(tiktok_url: str) -> Tuple[Optional[List[BytesIO]], Optional[str]]:
-    """Fetch TikTok photo post images using TikWM API"""
+async def _fetch_one(client: httpx.AsyncClient, sem: asyncio.Semaphore, url: str) -> Optional[BytesIO]:
+    """Download a single image, bounded by the shared semaphore"""
+    async with sem:
+        r = await client.get(url, timeout=30)
+        return BytesIO(r.content) if r.status_code == 200 else None
+
+async def fetch_photos(client: httpx.AsyncClient, tiktok_url: str,
+                       tikwm_data: Optional[dict] = None) -> Tuple[Optional[List[BytesIO]], Optional[str]]:
+    """Fetch TikTok photo post images using TikWM API (or the tikwm_data payload the caller already has)"""
     try:
-        # Resolve redirects
-        resolved_url = await resolve_redirect(tiktok_url)
-        print(f"Resolved URL: {resolved_url}")
-
-        tikwm_data = await tikwm_api_request(tiktok_url)
-        if tikwm_data:
-            images = tikwm_data.get('data', {}).get('images')
-            if images and isinstance(images, list):
-                buffers = []
-                async with httpx.AsyncClient(timeout=30) as client:
-                    for img_url in images:
-                        img_resp = await client.get(img_url)
-                        if img_resp.status_code == 200:
-                            buffers.append(BytesIO(img_resp.content))
-                if buffers:
-                    caption = f"Downloaded TikTok Photo Post - {tikwm_data.get('data', {}).get('title', 'TikTok Photos')}"
-                    return buffers, caption
+        if tikwm_data is None:
+            tikwm_data = await tikwm_api_request(client, tiktok_url)
+        if is_photo_post(tikwm_data):
+            info = tikwm_data['data']
+            images = info['images']
+            # Download all images concurrently; gather keeps the original order
+            sem = asyncio.Semaphore(PHOTO_DOWNLOAD_CONCURRENCY)
+            results = await asyncio.gather(
+                *[_fetch_one(client, sem, img_url) for img_url in images],
+                return_exceptions=True,
+            )
+            buffers = [r for r in results if isinstance(r, BytesIO)]
+            if buffers:
+                caption = f"Downloaded TikTok Photo Post - {info.get('title', 'TikTok Photos')}"
+                return buffers, caption
         return None, None
     except Exception as e:
-        print(f"⚠️ Photo download error: {e}")
+        logger.error("Photo download error: %s", e)
         return None, None
+
+async def fetch_post(client: httpx.AsyncClient, tiktok_url: str
+                     ) -> Tuple[Optional[List[BytesIO]], Optional[BytesIO], Optional[str]]:
+    """
+    Fetch a TikTok post: (images, None, caption) for photo posts, (None, video, caption) otherwise.
+    The video race starts alongside the single TikWM lookup, so the direct API fallback
+    never waits for a slow or failing TikWM to answer first.
+    """
+    cached = _cached_video(canonicalize_tiktok_url(tiktok_url))
+    if cached is not None:
+        # A cached video needs no TikWM lookup at all
+        video_bytes, caption = cached
+        return None, BytesIO(video_bytes), caption
+    tikwm_lookup = shared_tikwm_lookup(client, tiktok_url)
+    video_task = asyncio.ensure_future(fetch_video(client, tiktok_url, tikwm_lookup))
+    try:
+        await asyncio.wait({tikwm_lookup.task, video_task}, return_when=asyncio.FIRST_COMPLETED)
+        if tikwm_lookup.found_photo_post():
+            video_task.cancel()
+            photos, caption = await fetch_photos(client, tiktok_url, tikwm_lookup.task.result())
+            return photos, None, caption
+        video, caption = await video_task
+        return None, video, caption
+    finally:
+        video_task.cancel()